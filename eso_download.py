@@ -9,40 +9,66 @@ The following eso programmatic url page was exploited to make it user-friendly:
 http://archive.eso.org/programmatic/HOWTO/jupyter/authentication_and_authorisation/programmatic_authentication_and_authorisation.html
 """
 
-import requests
 import json
-import pyvo
-from pyvo.dal import tap
-from pyvo.auth.authsession import AuthSession
-import cgi
 import os
 import sys
 import re
 import shutil
-from tqdm import tqdm
-import numpy as np                                                                   
-import requests
+import socket
+import hashlib
 import getpass
-from astropy.io import fits
+import argparse
+import functools
+import threading
+import time
+import contextlib
+import concurrent.futures
+import multiprocessing
 from datetime import datetime, timedelta
-import importlib.metadata
 
-pyvo_version = importlib.metadata.version('pyvo')
-test_pyvo_version = (pyvo_version == '1.1' or pyvo_version > '1.2.1')
-if not test_pyvo_version:
-    print(f'You are using an unsupported version of pyvo (version={pyvo_version}).\n'
-          'Please use pyvo v1.1, v1.3, or higher, not v1.2* [ref. pyvo github issue #298].')
-    raise ImportError(f'The pyvo version you are using is not supported, use 1.3+ or 1.1.')
-    print(f'\npyvo version {pyvo_version} \n')
+# pyvo, astropy, numpy and requests take seconds to import, so they are imported on first use
+# inside the functions that need them: sorting-only and planning-only runs never pay for them.
 
 TAP_URL = "http://archive.eso.org/tap_obs"
 TOKEN_AUTHENTICATION_URL = "https://www.eso.org/sso/oidc/token"
 
+# Seconds after which the product claim of a worker on another host is considered stale and taken over
+CLAIM_TIMEOUT = 24 * 3600
+# Seconds after which a takeover of a stale claim is considered abandoned by a crashed worker
+TAKEOVER_TIMEOUT = 60
+
+@functools.lru_cache(maxsize=None)
+def import_pyvo():
+    """Import pyvo on first use and check that its version is supported."""
+    import pyvo
+    import importlib.metadata
+    pyvo_version = importlib.metadata.version('pyvo')
+    test_pyvo_version = (pyvo_version == '1.1' or pyvo_version > '1.2.1')
+    if not test_pyvo_version:
+        print(f'You are using an unsupported version of pyvo (version={pyvo_version}).\n'
+              'Please use pyvo v1.1, v1.3, or higher, not v1.2* [ref. pyvo github issue #298].')
+        raise ImportError(f'The pyvo version you are using is not supported, use 1.3+ or 1.1.')
+    return pyvo
+
+# Calibration categories to download, per instrument and per associated-files mode
+# (raw2raw, raw2master, night_log). '*' matches any instrument or mode. Each rule may list
+# categories to 'include' (everything if empty) and to 'exclude'.
+# Override or extend with a JSON file of the same layout (--calib-policy).
+CALIB_POLICY = {
+    '*': {
+        '*': {'include': [],
+              'exclude': ['WAVE_BAND', 'OH_SPEC', 'ATMOS_MODEL', 'SOLAR_SPEC',
+                          'SPEC_TYPE_LOOKUP', 'ARC_LIST', 'REF_LINES']},
+    },
+}
+
 def getToken(username, password):
     """Token based authentication to ESO: provide username and password to receive back a JSON Web Token."""
     if username==None or password==None:
         return None
 
+    import requests
+
     token = None
     try:
         response = requests.get(TOKEN_AUTHENTICATION_URL,
@@ -66,6 +92,7 @@ def createSession():
 
     token = getToken(username, password)
 
+    import requests
     session = requests.Session()
     if token:
         session.headers['Authorization'] = "Bearer " + token
@@ -96,24 +123,33 @@ def make_query():
     top_n_input = input("Number of files to select (or press Enter to select all): ")
     top_n = int(top_n_input) if top_n_input.isdigit() else None
 
-    query = f"select * from dbo.raw where dp_cat='{category}' and prog_id='{prog_id}'"
-    if obid and top_n and filter: #obid and topn and filter
-        query = f"select top {top_n} * from dbo.raw where dp_cat='{category}' and prog_id='{prog_id}' and ob_id='{obid}' and filter_path='{filter}'"
-    if not obid and top_n and filter: #topn and filter
-        query = f"select top {top_n} * from dbo.raw where dp_cat='{category}' and prog_id='{prog_id}' and filter_path='{filter}'"
-    if obid and top_n and not filter: #obid and topn
-        query = f"select top {top_n} * from dbo.raw where dp_cat='{category}' and prog_id='{prog_id}' and ob_id='{obid}'"
-    if obid and not top_n and filter: #obid and filter
-        query = f"select * from dbo.raw where dp_cat='{category}' and prog_id='{prog_id}' and ob_id='{obid}' and filter_path='{filter}'"
-    if obid and not top_n and not filter: #obid
-        query = f"select * from dbo.raw where dp_cat='{category}' and prog_id='{prog_id}' and ob_id='{obid}'"
-    if not obid and top_n and not filter: #topn
-        query = f"select top {top_n} * from dbo.raw where dp_cat='{category}' and prog_id='{prog_id}'"
-    if not obid and not top_n and filter: #filter
-        query = f"select * from dbo.raw where dp_cat='{category}' and prog_id='{prog_id}' and filter_path='{filter}'"
-
+    return build_query(prog_id, obid, filter, category, top_n)
+
+def build_query(prog_id, obid=None, filter=None, category='SCIENCE', top_n=None):
+    """ADQL query on dbo.raw for a program, optionally restricted to an OBID and filter, and to the first top_n files."""
+    query = "select "
+    if top_n:
+        query += f"top {top_n} "
+    query += f"* from dbo.raw where dp_cat='{category}' and prog_id='{prog_id}'"
+    if obid:
+        query += f" and ob_id='{obid}'"
+    if filter:
+        query += f" and filter_path='{filter}'"
     return query
 
+def assoc_mode(j):
+    """Map a mode of associated files (raw/processed/log) to the requested calSelector mode and datalink semantics."""
+    if j == 'processed':
+        mode_requested = 'raw2master'
+        return mode_requested, 'calSelector_' + mode_requested
+    elif j == 'log':
+        mode_requested = 'night_log'
+        return mode_requested, mode_requested
+    elif j == 'raw':
+        mode_requested = 'raw2raw'
+        return mode_requested, 'calSelector_' + mode_requested
+    return None, None
+
 def want_assoc_files():
     while True: #ask until typing an acceptable answer
         i = input("Do you also want to download associated files? [y/n]: ").lower()
@@ -121,20 +157,10 @@ def want_assoc_files():
             assoc = True
             while True:
                 j = input("Mode of associated files (raw/processed/log): ").lower()
-                if j == 'processed':
-                    mode_requested = 'raw2master'
-                    mode = 'calSelector_' + mode_requested
-                    break
-                elif j == 'log':
-                    mode_requested = 'night_log'
-                    mode = mode_requested
+                mode_requested, mode = assoc_mode(j)
+                if mode != None:
                     break
-                elif j == 'raw':
-                    mode_requested = 'raw2raw'
-                    mode = 'calSelector_' + mode_requested
-                    break
-                else:
-                    print("Invalid mode. Please enter 'raw', 'processed', or 'log'.")
+                print("Invalid mode. Please enter 'raw', 'processed', or 'log'.")
             break
         elif i == 'n':
             assoc = False
@@ -156,11 +182,16 @@ def printTableTransposedByTheRecord(table):
             print("{0}{1: <14} = {2}".format(prompt, col, row[col]) )
         print("{0}{1}".format(prompt,rec_sep))
 
-def run_job(query):
+def run_job(query, service=None, abort=True):
+    """Run the query as an asynchronous TAP job on service (default: the global tap service).
+       If nothing is found, quit, or return None when abort is False."""
+    pyvo = import_pyvo()
     results = None
+    if service == None:
+        service = tap
 
     # Define a job that will run the query asynchronously
-    job = tap.submit_job(query)
+    job = service.submit_job(query)
 
     # Extend maximum duration of job to 300s (default 60 seconds, max allowed 3600s)
     job.execution_duration = 300
@@ -194,56 +225,335 @@ def run_job(query):
         print("!       Aborting here.                   !")
         print("!                                        !")
         print("!" * 42)
-        quit()
+        if abort:
+            quit()
 
     return results
 
-def downloadURL(file_url, dirname='.', filename=None, session=None):
+def shard_of(dp_id, n_shards):
+    """Return the shard index (0..n_shards-1) a product belongs to. Stable across processes and hosts."""
+    digest = hashlib.md5(str(dp_id).strip().encode()).hexdigest()
+    return int(digest, 16) % n_shards
+
+def shard_results(results, shard_index, n_shards):
+    """Keep only the result rows whose dp_id hashes to this worker's shard."""
+    import numpy as np
+
+    table = results.to_table()
+    mask = np.array([shard_of(dp_id, n_shards) == shard_index for dp_id in table['dp_id']], dtype=bool)
+    print("Shard %d/%d: %d of %d products assigned to this worker" % (shard_index, n_shards, mask.sum(), len(table)))
+    return table[mask]
+
+def claims_dir(lock_dir, download_dir):
+    """Claims and done markers of a download directory inside a shared lock directory. Products are claimed per
+       download directory, so a product downloaded for one program is still fetched into another program's directory.
+       Workers must see the download directory under the same absolute path."""
+    if lock_dir == None:
+        return None
+    return os.path.join(lock_dir, re.sub(r'[^\w.\-]', '_', os.path.abspath(download_dir).strip('/')))
+
+def claim_paths(dp_id, lock_dir):
+    """Paths of the lock file (product being downloaded) and done marker (product downloaded) of a product."""
+    name = re.sub(r'[^\w.\-]', '_', str(dp_id).strip())
+    return os.path.join(lock_dir, name + '.lock'), os.path.join(lock_dir, name + '.done')
+
+def claim_is_stale(lock_path):
+    """A claim is stale if its worker is no longer running on this host, or it is older than CLAIM_TIMEOUT."""
+    try:
+        owner = open(lock_path).read().split()
+        age = time.time() - os.stat(lock_path).st_mtime
+    except FileNotFoundError:
+        return True
+    if len(owner) >= 2 and owner[0] == socket.gethostname() and owner[1].isdigit():
+        try:
+            os.kill(int(owner[1]), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+    return age > CLAIM_TIMEOUT
+
+def claim_product(dp_id, lock_dir):
+    """Atomically create a lock file for a product on the shared filesystem.
+       Returns True if this worker now owns the product, False if it is already downloaded or claimed by another worker.
+       Stale claims (crashed workers) are taken over, so an interrupted sharded run can be resumed."""
+    if lock_dir == None:
+        return True
+    os.makedirs(lock_dir, exist_ok=True)
+    lock_path, done_path = claim_paths(dp_id, lock_dir)
+    if os.path.exists(done_path):
+        return False
+    for attempt in range(2):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if attempt or not claim_is_stale(lock_path):
+                return False
+            take_over_stale_claim(lock_path)
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(claim_owner() + " %s\n" % (datetime.now().isoformat()))
+        return True
+    return False
+
+def claim_owner():
+    """Identify this worker in lock files: host and pid."""
+    return "%s %d" % (socket.gethostname(), os.getpid())
+
+def take_over_stale_claim(lock_path):
+    """Remove a stale lock. Takeovers are serialised by a second O_EXCL lock and the lock is checked again while
+       holding it, so a fresh lock created by a worker that took over first is never removed."""
+    takeover_path = lock_path + '.takeover'
+    try:
+        fd = os.open(takeover_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        # Another worker is taking over; clear its takeover lock only if it crashed while holding it
+        try:
+            if time.time() - os.stat(takeover_path).st_mtime > TAKEOVER_TIMEOUT:
+                os.remove(takeover_path)
+        except FileNotFoundError:
+            pass
+        return
+    os.close(fd)
+    try:
+        if os.path.exists(lock_path) and claim_is_stale(lock_path):
+            os.remove(lock_path)
+    except FileNotFoundError:
+        pass
+    finally:
+        os.remove(takeover_path)
+
+def release_product(dp_id, lock_dir, done):
+    """Release the claim of a product, leaving a done marker if it was downloaded so no worker fetches it again.
+       The lock is only removed if this worker still owns it."""
+    if lock_dir == None:
+        return
+    lock_path, done_path = claim_paths(dp_id, lock_dir)
+    if done:
+        with open(done_path, 'w') as f:
+            f.write(claim_owner() + " %s\n" % (datetime.now().isoformat()))
+    try:
+        with open(lock_path) as f:
+            owner = f.read().split()[:2]
+        if " ".join(owner) == claim_owner():
+            os.remove(lock_path)
+    except FileNotFoundError:
+        pass
+
+def download_claimed(file_url, dp_id, lock_dir, **kwargs):
+    """downloadURL for a product claimed in lock_dir. Returns (None, None) if it is done or claimed by another worker.
+       The claim is marked done on success and released on failure, so that it can be retried."""
+    if not claim_product(dp_id, lock_dir):
+        return None, None
+    status = None
+    try:
+        status, filepath = downloadURL(file_url, **kwargs)
+    finally:
+        release_product(dp_id, lock_dir, done=(status == 200))
+    return status, filepath
+
+def cache_key(file_url):
+    """Cache key of a product: its dp_id, i.e. anything after the last '/' of the access url."""
+    return re.sub(r'[^\w.\-]', '_', file_url[file_url.rindex('/')+1:])
+
+def link_from_cache(cached_path, filepath):
+    """Place a cached product at filepath: hardlink if possible, copy otherwise (e.g. cache on another filesystem).
+       No symlinks: they would dangle once the entry is evicted."""
+    if os.path.lexists(filepath):
+        os.remove(filepath)
+    try:
+        os.link(cached_path, filepath)
+    except OSError:
+        shutil.copyfile(cached_path, filepath)
+
+_cache_key_locks = {}
+_cache_key_locks_guard = threading.Lock()
+
+def cache_key_lock(key):
+    """Per-product lock, so a product is only downloaded into the cache once at a time by this process."""
+    with _cache_key_locks_guard:
+        return _cache_key_locks.setdefault(key, threading.Lock())
+
+CACHE_STAMP = '.last_used'
+
+def touch_cache_entry(entry_dir):
+    """Record the last use of a cache entry in its stamp file, which any user of a group-writable cache can update.
+       Failing to record it only affects the LRU order, never the download."""
+    stamp = os.path.join(entry_dir, CACHE_STAMP)
+    try:
+        os.utime(stamp)
+    except FileNotFoundError:
+        try:
+            open(stamp, 'a').close()
+        except OSError:
+            pass
+    except PermissionError:
+        # Stamp owned by another user and not group-writable: replace it (needs write access to the entry only)
+        tmp_stamp = "%s.%s.%d.%d" % (stamp, socket.gethostname(), os.getpid(), threading.get_ident())
+        try:
+            open(tmp_stamp, 'w').close()
+            os.replace(tmp_stamp, stamp)
+        except OSError:
+            pass
+
+def cache_lookup(cache_dir, file_url):
+    """Return the path of a cached product, or None. A hit refreshes the entry's last-use time for LRU eviction."""
+    entry_dir = os.path.join(cache_dir, cache_key(file_url))
+    if not os.path.isdir(entry_dir):
+        return None
+    names = [n for n in os.listdir(entry_dir) if not n.endswith('.part') and not n.startswith(CACHE_STAMP)]
+    if not names:
+        return None
+    cached_path = os.path.join(entry_dir, names[0])
+    touch_cache_entry(entry_dir)
+    return cached_path
+
+def evict_cache(cache_dir, cache_max_bytes):
+    """Delete least recently used products until the cache fits within cache_max_bytes.
+       This walks the whole cache, so it runs once at the end of a run or batch, not per download."""
+    if cache_dir == None or cache_max_bytes == None:
+        return
+    entries = []
+    total = 0
+    for key in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, key)
+        if not os.path.isdir(entry_dir):
+            continue
+        size = 0
+        last_used = 0
+        for n in os.listdir(entry_dir):
+            try:
+                st = os.stat(os.path.join(entry_dir, n))
+            except FileNotFoundError: # removed by a concurrent run
+                continue
+            size += st.st_size
+            last_used = max(last_used, st.st_mtime)
+        total += size
+        entries.append((last_used, size, entry_dir))
+    entries.sort()
+    for mtime, size, entry_dir in entries:
+        if total <= cache_max_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+        print("    CACHE: evicted %s" % (os.path.basename(entry_dir)))
+
+def parse_content_disposition(header):
+    """Parse the parameters of a Content-Disposition header (lightweight replacement of the deprecated cgi.parse_header)."""
+    params = {}
+    for m in re.finditer(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)', header):
+        key, value = m.group(1).lower(), m.group(2).strip()
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        params[key] = value
+    return params
+
+def downloadURL(file_url, dirname='.', filename=None, session=None, cache_dir=None):
     """Method to download a file, either anonymously (no session or session not "tokenized"), or authenticated (if session with token is provided).
+       If cache_dir is given, products are stored there once by dp_id and linked into dirname,
+       except for authenticated downloads, which are never cached.
        It returns: http status, and filepath on disk (if successful)"""
 
     if dirname != None:
         if not os.access(dirname, os.W_OK):
             print("ERROR: Provided directory (%s) is not writable" % (dirname))
             sys.exit(1)
-      
-    if session!=None:
-        response = session.get(file_url, stream=True)
-    else:
-        # no session -> no authentication
-        response = requests.get(file_url, stream=True)
 
-    # If not provided, define the filename from the response header
-    if filename == None:
-        contentdisposition = response.headers.get('Content-Disposition')
-        if contentdisposition != None:                                                                                                             
-            value, params = cgi.parse_header(contentdisposition)
-            filename = params["filename"]
+    # Authenticated downloads may be proprietary: never share them through the site-wide cache
+    if session != None and session.headers.get('Authorization'):
+        cache_dir = None
+
+    # Threads of a batch fetching the same product wait for the first download, then hit the cache
+    lock = cache_key_lock(cache_key(file_url)) if cache_dir != None else contextlib.nullcontext()
+    with lock:
+        if cache_dir != None:
+            cached_path = cache_lookup(cache_dir, file_url)
+            if cached_path != None:
+                if filename == None:
+                    filename = os.path.basename(cached_path)
+                filepath = filename if dirname == None else dirname + '/' + filename
+                link_from_cache(cached_path, filepath)
+                return (200, filepath)
+
+        if session!=None:
+            response = session.get(file_url, stream=True)
+        else:
+            # no session -> no authentication
+            import requests
+            response = requests.get(file_url, stream=True)
 
-        # if the response header does not provide a name, derive a name from the URL
+        # If not provided, define the filename from the response header
         if filename == None:
-            # last chance: get anything after the last '/'
-            filename = file_url[file_url.rindex('/')+1:]
-
-    # define the file path where the file is going to be stored
-    if dirname == None:
-        filepath = filename
-    else:
-        filepath = dirname + '/' + filename
+            contentdisposition = response.headers.get('Content-Disposition')
+            if contentdisposition != None:                                                                                                             
+                params = parse_content_disposition(contentdisposition)
+                filename = params.get("filename")
+
+            # if the response header does not provide a name, derive a name from the URL
+            if filename == None:
+                # last chance: get anything after the last '/'
+                filename = file_url[file_url.rindex('/')+1:]
+
+        # define the file path where the file is going to be stored
+        if dirname == None:
+            filepath = filename
+        else:
+            filepath = dirname + '/' + filename
+
+        if response.status_code == 200:
+            if cache_dir != None:
+                # Write into the cache first (atomically, other runs may share it), then link into the run directory
+                entry_dir = os.path.join(cache_dir, cache_key(file_url))
+                os.makedirs(entry_dir, exist_ok=True)
+                cached_path = os.path.join(entry_dir, os.path.basename(filename))
+                # Unique per host, process and thread; mode 0666 minus umask (not mkstemp's 0600) so other users can read it
+                tmp_path = "%s.%s.%d.%d.part" % (cached_path, socket.gethostname(), os.getpid(), threading.get_ident())
+                fd = os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=50000):
+                            f.write(chunk)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+                try:
+                    os.replace(tmp_path, cached_path)
+                except FileNotFoundError:
+                    # Entry removed meanwhile by another run: serve whatever copy is now in the cache
+                    cached_path = cache_lookup(cache_dir, file_url)
+                    if cached_path == None:
+                        raise
+                touch_cache_entry(entry_dir)
+                link_from_cache(cached_path, filepath)
+            else:
+                with open(filepath, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=50000):
+                        f.write(chunk)
 
-    if response.status_code == 200:
-        with open(filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=50000):
-                f.write(chunk)
+        return (response.status_code, filepath)
 
-    return (response.status_code, filepath)
+def map_downloads(download, items, executor=None):
+    """Apply download to each item, in turn or on a shared executor, yielding (item, result) as downloads finish."""
+    if executor == None:
+        for item in items:
+            yield item, download(item)
+    else:
+        futures = {executor.submit(download, item): item for item in items}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
 
-def download_raw(results,download_dir,session=None):
+def download_raw(results,download_dir,session=None,lock_dir=None,cache_dir=None,executor=None):
     print("\nStarting raw download...")
-    for raw in results:
-        access_url = raw['access_url'] # the access_url is the link to the raw file
-        status, filepath = downloadURL(access_url, session=session, dirname=download_dir)
-        if status==200:
+    # the access_url is the link to the raw file
+    products = [(raw['access_url'], raw['dp_id']) for raw in results]
+
+    download = lambda product: download_claimed(product[0], product[1], lock_dir, session=session,
+                                                dirname=download_dir, cache_dir=cache_dir)
+    for (access_url, dp_id), (status, filepath) in map_downloads(download, products, executor):
+        if status==None:
+            print("     SKIP: %s already downloaded or claimed by another worker" % (dp_id))
+        elif status==200:
             print("      RAW: %s downloaded  "  % (filepath))
         else:
             print("ERROR RAW: %s NOT DOWNLOADED (http status:%d)"  % (filepath, status))
@@ -303,7 +613,58 @@ def printCalselectorInfo(description, mode_requested):
 
     return alert, mode_warning, certified_warning
 
-def download_assoc(results,mode_requested,mode,download_dir,session=None):
+def select_calib_policy(policy, instrument, mode_requested):
+    """Return the include/exclude rule of the policy for an instrument and mode, falling back to '*' entries."""
+    instrument_policy = policy.get(str(instrument).strip(), policy.get('*', {}))
+    rule = instrument_policy.get(mode_requested, instrument_policy.get('*'))
+    if rule == None:
+        rule = policy.get('*', {}).get(mode_requested, policy.get('*', {}).get('*', {}))
+    return rule
+
+def load_calib_policy(path):
+    """Read a calibration policy from a JSON file, merged into CALIB_POLICY per instrument and mode:
+       a rule of the file replaces the default rule of the same instrument and mode only."""
+    policy = {instrument: dict(modes) for instrument, modes in CALIB_POLICY.items()}
+    if path != None:
+        with open(path) as f:
+            for instrument, modes in json.load(f).items():
+                policy.setdefault(instrument, {}).update(modes)
+    return policy
+
+def calib_category_mask(categories, rule):
+    """Vectorised membership test of eso_category values against an include/exclude rule."""
+    import numpy as np
+
+    categories = np.asarray(categories, dtype=str)
+    mask = np.ones(len(categories), dtype=bool)
+    if rule.get('include'):
+        mask &= np.isin(categories, rule['include'])
+    if rule.get('exclude'):
+        mask &= ~np.isin(categories, rule['exclude'])
+    return mask
+
+def printCalibReport(calib_table):
+    """Print the number of files and bytes per calibration category, before anything is transferred."""
+    import numpy as np
+
+    categories = np.asarray(calib_table['eso_category'], dtype=str)
+    if 'content_length' in calib_table.colnames:
+        sizes = np.ma.filled(np.ma.asarray(calib_table['content_length'], dtype=float), 0)
+    else:
+        sizes = np.zeros(len(calib_table))
+    print("    calibration transfer report:")
+    print("    ------------------------------------")
+    for category in np.unique(categories):
+        sel = categories == category
+        print("    {0: <24} {1:5d} files {2:10.1f} MB".format(category, sel.sum(), sizes[sel].sum() / 1e6))
+    print("    {0: <24} {1:5d} files {2:10.1f} MB".format('TOTAL', len(categories), sizes.sum() / 1e6))
+
+def download_assoc(results,mode_requested,mode,download_dir,session=None,lock_dir=None,cache_dir=None,
+                   policy=CALIB_POLICY,executor=None):
+    pyvo = import_pyvo()
+    import numpy as np
+    import astropy.table
+
     if mode == 'processed':
         print('\nDownloading associated processed calibration files')
     elif mode  == 'log':
@@ -311,8 +672,9 @@ def download_assoc(results,mode_requested,mode,download_dir,session=None):
     else:
         print('\nDownloading associated raw calibration files')
 
-    #Download associated files for each unique night (midday day1 to midday day2)
+    #Select associated files for each unique night (midday day1 to midday day2)
     processed_nights = set()
+    night_calibs = []
     for raw in results:
         exp_start = raw['exp_start']
         if '.' in exp_start:
@@ -340,14 +702,15 @@ def download_assoc(results,mode_requested,mode,download_dir,session=None):
             assoc_files = pyvo.dal.adhoc.DatalinkResults.from_result_url(assoc_url, session=session)
 
             # Create and use a mask to get only the #calibration entries (not #this or ...#sibling_raw centries)
-            calibrator_mask = (assoc_files['semantics'] == '#calibration') & \
-                    (assoc_files['eso_category'] != 'WAVE_BAND') & (assoc_files['eso_category'] != 'OH_SPEC') &\
-                    (assoc_files['eso_category'] != 'ATMOS_MODEL') &  (assoc_files['eso_category'] != 'SOLAR_SPEC') &\
-                    (assoc_files['eso_category'] != 'SPEC_TYPE_LOOKUP') &  (assoc_files['eso_category'] != 'ARC_LIST') &\
-                    (assoc_files['eso_category'] != 'REF_LINES')
-            calib_urls = assoc_files.to_table()[calibrator_mask]['access_url','eso_category']
-            printTableTransposedByTheRecord(calib_urls)
-            print('There are %d calib files to download'%len(calib_urls))
+            # whose category is selected by the policy for this instrument and mode
+            rule = select_calib_policy(policy, raw['instrument'], mode_requested)
+            assoc_table = assoc_files.to_table()
+            calibrator_mask = (np.asarray(assoc_table['semantics'], dtype=str) == '#calibration') & \
+                    calib_category_mask(assoc_table['eso_category'], rule)
+            calib_table = assoc_table[calibrator_mask]
+            printTableTransposedByTheRecord(calib_table['access_url','eso_category'])
+            print('There are %d calib files selected (%d skipped by policy)' % (len(calib_table),
+                  (np.asarray(assoc_table['semantics'], dtype=str) == '#calibration').sum() - len(calib_table)))
 
             this_description=next(assoc_files.bysemantics('#this')).description
 
@@ -359,28 +722,32 @@ def download_assoc(results,mode_requested,mode,download_dir,session=None):
                 print("%s" % (mode_warning))
             if certified_warning!="":
                 print("%s" % (certified_warning))
-                
-            # question = None
-            # answer = None
-            if len(calib_urls):
-                # while answer != 'y' and answer != 'n':
-                #     print()
-                    # if alert or mode_warning or certified_warning:    
-                    #     print("Given the above warning(s), do you still want to download these %d calib files [y/n]? "%(len(calib_urls))).lower()
-                    # else:
-                    #     print("No warnings reported, continuing to download these %d calib files"%(len(calib_urls)))
-
-                i_calib=0
-                for url,category in calib_urls:
-                    i_calib+=1
-                    status, filename = downloadURL(url, dirname=download_dir)
-                    if status==200:
-                        print("    CALIB: %4d/%d dp_id: %s (%s) downloaded"  % (i_calib, len(calib_urls), filename, category))
-                    else:
-                        print("    CALIB: %4d/%d dp_id: %s (%s) NOT DOWNLOADED (http status:%d)"  % (i_calib, len(calib_urls), filename, category, status))
 
+            night_calibs.append(calib_table)
             processed_nights.add(obs_night)
 
+    if not night_calibs:
+        return
+
+    # Nights of the same run often share calibrations: report and download each product once
+    calib_table = astropy.table.unique(astropy.table.vstack(night_calibs), keys='access_url')
+    printCalibReport(calib_table)
+
+    # Calibrations are shared between nights of different shards, so claim each one by dp_id
+    products = [(url, url[url.rindex('/')+1:], category) for url,category in calib_table['access_url','eso_category']]
+
+    i_calib=0
+    download = lambda product: download_claimed(product[0], product[1], lock_dir, dirname=download_dir,
+                                                session=session, cache_dir=cache_dir)
+    for (url, calib_id, category), (status, filename) in map_downloads(download, products, executor):
+        i_calib+=1
+        if status==None:
+            print("    CALIB: %4d/%d dp_id: %s (%s) already downloaded or claimed by another worker"  % (i_calib, len(products), calib_id, category))
+        elif status==200:
+            print("    CALIB: %4d/%d dp_id: %s (%s) downloaded"  % (i_calib, len(products), filename, category))
+        else:
+            print("    CALIB: %4d/%d dp_id: %s (%s) NOT DOWNLOADED (http status:%d)"  % (i_calib, len(products), filename, category, status))
+
 def get_valid_calibration_range(science_date):
     """Returns the valid calibration time range based on the observation time of the science file."""
     obs_time = datetime.strptime(science_date, "%Y-%m-%dT%H:%M:%S.%f")
@@ -427,10 +794,12 @@ def want_tree():
         print("Invalid input. Please enter 'y' or 'n'.")
     return tree
 
-def make_tree(download_dir):
+def make_tree(download_dir, compress=False, processes=None, pool=None):
+    from astropy.io import fits
 
     print('\nDecompressing files')
-    os.system(f'parallel uncompress ::: {download_dir}/*.Z')
+    # Decompress into new files and only then drop the .Z: uncompress refuses files hardlinked from the cache
+    os.system(f"parallel 'gzip -dc {{}} > {{.}} && rm {{}}' ::: {download_dir}/*.Z")
 
     files = os.listdir(download_dir)
     sorted_files = sorted(files)
@@ -459,6 +828,7 @@ def make_tree(download_dir):
 
     print('Found the following nights:')
     nights = []
+    sorted_paths = []
     for fndx, f in enumerate(science_files):
         fpath = os.path.join(download_dir, f)
         hdr = fits.open(fpath)[0].header
@@ -495,7 +865,7 @@ def make_tree(download_dir):
         # Create directory structure for the science file and move it
         science_dir = os.path.join(download_dir, night_str, obids[fndx], 'science')
         os.makedirs(science_dir, exist_ok=True)
-        shutil.move(fpath, science_dir)
+        sorted_paths.append(shutil.move(fpath, science_dir))
 
     #Organise cal files
     for fndx, f in enumerate(cal_files):
@@ -516,12 +886,263 @@ def make_tree(download_dir):
         # Create directory structure for the cal file and move it
         cal_dir = os.path.join(download_dir, night_str, 'cal')
         os.makedirs(cal_dir, exist_ok=True)
-        shutil.move(fpath, cal_dir)
+        sorted_paths.append(shutil.move(fpath, cal_dir))
+
+    if compress:
+        compress_tree(sorted_paths, processes, pool)
 
     print("\nDone!")
 
+# Structural keywords rewritten by tile compression, not compared when verifying a compressed file
+COMPRESSION_KEYWORDS = ('SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'EXTEND', 'PCOUNT', 'GCOUNT',
+                        'BZERO', 'BSCALE', 'CHECKSUM', 'DATASUM')
+
+def compress_fits(fpath):
+    """Convert a FITS file to tile-compressed FITS (fpack-style .fz) and verify that headers and data round-trip.
+       Integer images use lossless RICE_1, floating point images lossless GZIP_2 (Rice would quantize them).
+       A primary image moves to the first extension, its header is kept in the primary HDU so that
+       keywords like DATE and OBJECT are still read from [0].
+       On success the original is removed, on any failure the original is kept and the partial .fz removed.
+       Returns (fpath, compressed path or None, message)."""
+    out_path = fpath + '.fz'
+    try:
+        message = write_compressed_fits(fpath, out_path)
+    except Exception as e: # e.g. BITPIX not supported by the compression, corrupt or truncated file
+        message = "%s: %s" % (type(e).__name__, e)
+
+    if message:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        return fpath, None, message
+    os.remove(fpath)
+    return fpath, out_path, "compressed"
+
+def write_compressed_fits(fpath, out_path):
+    """Write the tile-compressed copy of fpath to out_path, then verify it. Returns None if it round-trips,
+       otherwise a message describing the first difference."""
+    import numpy as np
+    from astropy.io import fits
+
+    with fits.open(fpath) as hdul:
+        offset = 1 if hdul[0].data is not None else 0
+        new_hdul = fits.HDUList()
+        if offset:
+            header = hdul[0].header.copy()
+            for n in range(header['NAXIS'], 0, -1):
+                header.remove('NAXIS%d' % n, ignore_missing=True)
+            header['NAXIS'] = 0
+            header.remove('BZERO', ignore_missing=True)
+            header.remove('BSCALE', ignore_missing=True)
+            new_hdul.append(fits.PrimaryHDU(header=header))
+        for hdu in hdul:
+            if hdu.is_image and hdu.data is not None:
+                if np.issubdtype(hdu.data.dtype, np.floating):
+                    new_hdul.append(fits.CompImageHDU(hdu.data, header=hdu.header,
+                                                      compression_type='GZIP_2', quantize_level=0.0))
+                else:
+                    new_hdul.append(fits.CompImageHDU(hdu.data, header=hdu.header, compression_type='RICE_1'))
+            else:
+                new_hdul.append(hdu.copy())
+        new_hdul.writeto(out_path, overwrite=True)
+
+    # Verify the round trip: every original keyword and every image must be found unchanged
+    message = None
+    with fits.open(fpath) as orig, fits.open(out_path) as comp:
+        for i, hdu in enumerate(orig):
+            new = comp[i + offset]
+            for card in hdu.header.cards:
+                if card.keyword.startswith(COMPRESSION_KEYWORDS) or card.keyword in ('COMMENT', 'HISTORY', ''):
+                    continue
+                if card.keyword not in new.header or new.header[card.keyword] != card.value:
+                    message = "header keyword %s of HDU %d differs" % (card.keyword, i)
+                    break
+            if message == None and hdu.data is not None and not hdu_data_equal(hdu, new):
+                message = "data of HDU %d differs" % (i)
+            if message:
+                break
+    return message
+
+def hdu_data_equal(hdu, new):
+    """Compare the data of two HDUs; NaN (blank pixels, missing table values) compares equal to itself.
+       Tables are compared column by column, as record arrays cannot be compared with equal_nan."""
+    import numpy as np
+
+    if hdu.is_image:
+        return np.array_equal(hdu.data, new.data, equal_nan=np.issubdtype(hdu.data.dtype, np.floating))
+    if hdu.data.dtype.names == None:
+        return np.array_equal(hdu.data, new.data)
+    if new.data is None or hdu.data.dtype.names != new.data.dtype.names:
+        return False
+    for name in hdu.data.dtype.names:
+        col, new_col = np.asarray(hdu.data[name]), np.asarray(new.data[name])
+        if not np.array_equal(col, new_col, equal_nan=np.issubdtype(col.dtype, np.floating)):
+            return False
+    return True
+
+def make_compress_pool(processes=None):
+    """Process pool for compress_fits. Workers are spawned, not forked: the batch mode forks from a multi-threaded process."""
+    return concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+def compress_tree(paths, processes=None, pool=None):
+    """Tile-compress the organised FITS files on a pool of processes (a new one unless a shared pool is given)."""
+    paths = [p for p in paths if p.endswith('.fits')]
+    print('\nTile-compressing %d files' % len(paths))
+    with make_compress_pool(processes) if pool == None else contextlib.nullcontext(pool) as pool:
+        for fpath, out_path, message in pool.map(compress_fits, paths):
+            if out_path:
+                print("    %s -> %s (%.1f MB)" % (fpath, out_path, os.path.getsize(out_path) / 1e6))
+            else:
+                print("ERROR: %s NOT COMPRESSED, kept uncompressed (%s)" % (fpath, message))
+
+def createPooledSession(token=None, pool_size=10):
+    """Session shared by all programs of a batch, with a connection pool large enough for the parallel downloads."""
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if token:
+        session.headers['Authorization'] = "Bearer " + token
+    return session
+
+def run_program(spec, service, session, executor, args, compress_pool=None):
+    """Query, download and organise one program of a batch job spec."""
+    prog_id = spec['prog_id']
+    query = build_query(prog_id, spec.get('obid'), spec.get('filter'),
+                        spec.get('category', 'SCIENCE').upper(), spec.get('top_n'))
+    print("\n[%s] %s" % (prog_id, query))
+    results = run_job(query, service=service, abort=False)
+    if not results:
+        return
+
+    download_dir = spec.get('download_dir', re.sub(r'[^\w.\-]', '_', prog_id))
+    os.makedirs(download_dir, exist_ok=True)
+    lock_dir = claims_dir(args.lock_dir, download_dir)
+    if args.n_shards != None:
+        results = shard_results(results, args.shard_index, args.n_shards)
+        if lock_dir == None:
+            lock_dir = os.path.join(download_dir, '.eso_locks')
+    download_raw(results,download_dir,session=session,lock_dir=lock_dir,
+                 cache_dir=args.cache_dir,executor=executor)
+
+    if spec.get('assoc'):
+        mode_requested, mode = assoc_mode(spec['assoc'].lower())
+        download_assoc(results,mode_requested,mode,download_dir,session=session,lock_dir=lock_dir,
+                       cache_dir=args.cache_dir,policy=args.calib_policy,executor=executor)
+
+    if spec.get('tree') and args.n_shards == None:
+        make_tree(download_dir, compress=spec.get('compress', args.compress), pool=compress_pool)
+
+def run_batch(spec_path, args):
+    """Run every program of a JSON job spec concurrently, sharing one session, TAP service and download pool.
+
+       The spec looks like:
+       {"authenticate": false,
+        "programs": [{"prog_id": "...", "obid": null, "filter": null, "category": "SCIENCE", "top_n": null,
+                      "assoc": "raw", "tree": true, "compress": true, "download_dir": "..."}]}
+       Credentials for authenticated batches are read from $ESO_USERNAME and $ESO_PASSWORD."""
+    with open(spec_path) as f:
+        job_spec = json.load(f)
+    programs = job_spec['programs']
+
+    for spec in programs:
+        if spec.get('assoc') and assoc_mode(spec['assoc'].lower())[1] == None:
+            print("ERROR: invalid assoc mode %s for program %s, use 'raw', 'processed', or 'log'" % (spec['assoc'], spec['prog_id']))
+            sys.exit(1)
+
+    token = None
+    if job_spec.get('authenticate'):
+        token = getToken(os.environ.get('ESO_USERNAME'), os.environ.get('ESO_PASSWORD'))
+        if not token:
+            print("ERROR: authentication requested but no valid $ESO_USERNAME/$ESO_PASSWORD provided")
+            sys.exit(1)
+    # Downloads and the TAP/datalink requests of the program threads all go through this session
+    session = createPooledSession(token, pool_size=args.max_downloads + args.max_programs)
+
+    pyvo = import_pyvo()
+    service = pyvo.dal.TAPService(TAP_URL, session=session)
+
+    # One compression pool for the whole batch, created before any program thread runs
+    compress = any(spec.get('tree') and spec.get('compress', args.compress) for spec in programs)
+    compress_pool = make_compress_pool(args.compress_processes) if compress else contextlib.nullcontext()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_downloads) as executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=args.max_programs) as program_pool, \
+            compress_pool:
+        futures = {program_pool.submit(run_program, spec, service, session, executor, args,
+                                       compress_pool if compress else None): spec['prog_id']
+                   for spec in programs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print("ERROR: program %s failed: %s" % (futures[future], e))
+
+    evict_cache(args.cache_dir, args.cache_max_bytes)
+
+    print("\nBatch done!")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Download data from the ESO science archive')
+    parser.add_argument('--shard', default=None,
+                        help='Process only shard I of N of the query results, given as I/N (e.g. 0/4). '
+                             'Every worker must run the same query.')
+    parser.add_argument('--tree', default=None, metavar='DIR',
+                        help='Only organise the files of DIR into the tree and exit, '
+                             'e.g. once all shards of a sharded download have finished')
+    parser.add_argument('--lock-dir', default=None,
+                        help='Shared directory used to claim products so two workers never fetch the same file '
+                             'into the same download directory (default: <download_dir>/.eso_locks when sharding)')
+    parser.add_argument('--calib-policy', default=None,
+                        help='JSON file of calibration categories to include/exclude per instrument and mode '
+                             '(see CALIB_POLICY)')
+    parser.add_argument('--cache-dir', default=os.environ.get('ESO_CACHE_DIR'),
+                        help='Site-wide cache: products are stored there once by dp_id and hardlinked '
+                             '(or copied) into the download directory (default: $ESO_CACHE_DIR)')
+    parser.add_argument('--cache-max-gb', type=float, default=os.environ.get('ESO_CACHE_MAX_GB'),
+                        help='Size limit of the cache; least recently used products are evicted '
+                             '(default: $ESO_CACHE_MAX_GB, unlimited if unset)')
+    parser.add_argument('--batch', default=None, metavar='SPEC',
+                        help='Run non-interactively the programs listed in a JSON job spec (see run_batch)')
+    parser.add_argument('--max-programs', type=int, default=2,
+                        help='Number of programs of a batch queried and processed at the same time (default: 2)')
+    parser.add_argument('--max-downloads', type=int, default=8,
+                        help='Number of parallel downloads shared by all programs of a batch (default: 8)')
+    parser.add_argument('--compress', action='store_true',
+                        help='After organising into the tree, convert frames to tile-compressed FITS (.fits.fz)')
+    parser.add_argument('--compress-processes', type=int, default=None,
+                        help='Number of processes used for compression (default: number of CPUs)')
+    args = parser.parse_args()
+
+    args.shard_index, args.n_shards = None, None
+    if args.shard != None:
+        m = re.match(r'^(\d+)/(\d+)$', args.shard)
+        if not m or int(m.group(1)) >= int(m.group(2)):
+            parser.error("--shard must be I/N with 0 <= I < N")
+        args.shard_index, args.n_shards = int(m.group(1)), int(m.group(2))
+
+    args.calib_policy = load_calib_policy(args.calib_policy)
+
+    args.cache_max_bytes = None
+    if args.cache_max_gb != None:
+        args.cache_max_bytes = int(float(args.cache_max_gb) * 1024**3)
+    if args.cache_dir != None:
+        os.makedirs(args.cache_dir, exist_ok=True)
+    return args
+
 if __name__ == "__main__":
 
+    args = parse_args()
+
+    if args.tree != None:
+        make_tree(args.tree, compress=args.compress, processes=args.compress_processes)
+        sys.exit(0)
+
+    if args.batch != None:
+        run_batch(args.batch, args)
+        sys.exit(0)
+
     print()
     print('--------- ESO Science Archive data download ---------')
     print('This script is best setup to do the following:')
@@ -534,6 +1155,7 @@ if __name__ == "__main__":
     session = authenticate()
 
     # Step 1: Initialise a tap service for anonymous queries (you will not be able to find any file with protected metadata)
+    pyvo = import_pyvo()
     tap = pyvo.dal.TAPService(TAP_URL, session=session)
 
     # Step 2: Make query using search criteria
@@ -542,20 +1164,34 @@ if __name__ == "__main__":
     # Step 3: Ask to download associated files
     assoc, mode_requested, mode = want_assoc_files()
 
-    # Step 4: Ask to sort files into tree
-    tree = want_tree()
+    # Step 4: Ask to sort files into tree (not while other shards may still be writing the same directory)
+    if args.n_shards != None:
+        print("Sharded run: files are not organised into a tree. Once all shards have finished, run:\n"
+              "    python eso_download.py --tree <download_dir>")
+        tree = False
+    else:
+        tree = want_tree()
 
     # Step 5: Run job
     results = run_job(query)
 
     # Step 6: Download data
     download_dir = '.'
-    download_raw(results,download_dir)
+    lock_dir = claims_dir(args.lock_dir, download_dir)
+    if args.n_shards != None:
+        results = shard_results(results, args.shard_index, args.n_shards)
+        if lock_dir == None:
+            lock_dir = os.path.join(download_dir, '.eso_locks')
+    download_raw(results,download_dir,lock_dir=lock_dir,
+                 cache_dir=args.cache_dir)
 
     # Step 7: Download associated files 
     if assoc:
-        download_assoc(results,mode_requested,mode,download_dir)
+        download_assoc(results,mode_requested,mode,download_dir,lock_dir=lock_dir,
+                       cache_dir=args.cache_dir,policy=args.calib_policy)
+
+    evict_cache(args.cache_dir, args.cache_max_bytes)
 
     # Step 8: Sort files into tree
     if tree:
-        make_tree(download_dir)
+        make_tree(download_dir, compress=args.compress, processes=args.compress_processes)
@@ -0,0 +1,48 @@
+"""Site-wide product cache: lookup, linking into the run directory and LRU eviction."""
+
+import os
+
+import eso_download
+
+
+def add_entry(cache_dir, key, size, last_used):
+    entry_dir = cache_dir / key
+    entry_dir.mkdir()
+    product = entry_dir / (key + '.fits.Z')
+    product.write_bytes(b'x' * size)
+    os.utime(product, (last_used, last_used))
+    return product
+
+def test_cache_lookup_miss(tmp_path):
+    assert eso_download.cache_lookup(str(tmp_path), 'http://archive.eso.org/file/DP.1') == None
+
+def test_cache_lookup_hit_records_use(tmp_path):
+    product = add_entry(tmp_path, 'DP.1', 10, 1)
+    cached_path = eso_download.cache_lookup(str(tmp_path), 'http://archive.eso.org/file/DP.1')
+    assert cached_path == str(product)
+    assert (tmp_path / 'DP.1' / eso_download.CACHE_STAMP).stat().st_mtime > 1
+
+def test_cache_lookup_ignores_partial_downloads(tmp_path):
+    (tmp_path / 'DP.1').mkdir()
+    (tmp_path / 'DP.1' / 'DP.1.fits.Z.host.1.2.part').write_bytes(b'x')
+    assert eso_download.cache_lookup(str(tmp_path), 'http://archive.eso.org/file/DP.1') == None
+
+def test_link_from_cache_hardlinks(tmp_path):
+    product = add_entry(tmp_path, 'DP.1', 10, 1)
+    filepath = str(tmp_path / 'run.fits.Z')
+    eso_download.link_from_cache(str(product), filepath)
+    assert os.path.samefile(product, filepath)
+
+def test_evict_cache_removes_least_recently_used(tmp_path):
+    add_entry(tmp_path, 'A', 100, 1)
+    add_entry(tmp_path, 'B', 100, 2)
+    add_entry(tmp_path, 'C', 100, 3)
+    # A hit makes A the most recently used entry
+    eso_download.cache_lookup(str(tmp_path), 'http://archive.eso.org/file/A')
+    eso_download.evict_cache(str(tmp_path), 150)
+    assert sorted(os.listdir(tmp_path)) == ['A']
+
+def test_evict_cache_without_limit_keeps_everything(tmp_path):
+    add_entry(tmp_path, 'A', 100, 1)
+    eso_download.evict_cache(str(tmp_path), None)
+    assert os.listdir(tmp_path) == ['A']
@@ -0,0 +1,19 @@
+"""Content-Disposition parsing (replacement of the deprecated cgi.parse_header)."""
+
+import eso_download
+
+
+def test_quoted_filename():
+    header = 'attachment; filename="HAWKI.2020-01-01T00:00:00.000.fits.Z"'
+    assert eso_download.parse_content_disposition(header) == {'filename': 'HAWKI.2020-01-01T00:00:00.000.fits.Z'}
+
+def test_unquoted_filename_and_other_params():
+    params = eso_download.parse_content_disposition('inline; FileName=a.fits; size=12')
+    assert params == {'filename': 'a.fits', 'size': '12'}
+
+def test_semicolon_and_escapes_inside_quotes():
+    params = eso_download.parse_content_disposition(r'attachment; filename="a;b \"c\".fits"')
+    assert params['filename'] == 'a;b "c".fits'
+
+def test_no_params():
+    assert eso_download.parse_content_disposition('attachment') == {}
@@ -0,0 +1,72 @@
+"""Sharding of query results and product claims on a shared lock directory."""
+
+import os
+import socket
+
+import eso_download
+
+
+def test_shard_of_is_stable():
+    # md5 based, so the same on every host, process and Python version (unlike hash())
+    dp_id = 'HAWKI.2020-01-01T00:00:00.000'
+    assert [eso_download.shard_of(dp_id, n) for n in (2, 4, 7)] == [0, 0, 5]
+    assert eso_download.shard_of(' %s ' % dp_id, 7) == 5
+
+def test_shard_of_covers_all_shards():
+    shards = {eso_download.shard_of('DP.%d' % i, 4) for i in range(100)}
+    assert shards == {0, 1, 2, 3}
+
+def test_claim_release_cycle(tmp_path):
+    lock_dir = str(tmp_path)
+    assert eso_download.claim_product('DP1', lock_dir)
+    assert not eso_download.claim_product('DP1', lock_dir)
+
+    # A failed download releases the claim so it can be retried
+    eso_download.release_product('DP1', lock_dir, done=False)
+    assert os.listdir(lock_dir) == []
+    assert eso_download.claim_product('DP1', lock_dir)
+
+    # A successful one leaves a done marker
+    eso_download.release_product('DP1', lock_dir, done=True)
+    assert os.listdir(lock_dir) == ['DP1.done']
+    assert not eso_download.claim_product('DP1', lock_dir)
+
+def test_download_claimed_releases_on_failure(tmp_path, monkeypatch):
+    lock_dir = str(tmp_path)
+    statuses = iter([(500, 'f'), (200, 'f')])
+    monkeypatch.setattr(eso_download, 'downloadURL', lambda url, **kwargs: next(statuses))
+    assert eso_download.download_claimed('u', 'DP1', lock_dir) == (500, 'f')
+    assert eso_download.download_claimed('u', 'DP1', lock_dir) == (200, 'f')
+    assert eso_download.download_claimed('u', 'DP1', lock_dir) == (None, None)
+
+def test_stale_claim_of_dead_worker_is_taken_over(tmp_path):
+    lock_path = tmp_path / 'DP1.lock'
+    lock_path.write_text('%s 999999999 2020-01-01T00:00:00\n' % socket.gethostname())
+    assert eso_download.claim_product('DP1', str(tmp_path))
+    assert lock_path.read_text().startswith(eso_download.claim_owner())
+
+def test_live_claims_are_kept(tmp_path):
+    lock_path = tmp_path / 'DP1.lock'
+    lock_path.write_text('%s %d 2020-01-01T00:00:00\n' % (socket.gethostname(), os.getppid()))
+    assert not eso_download.claim_product('DP1', str(tmp_path))
+    (tmp_path / 'DP2.lock').write_text('otherhost 1 2020-01-01T00:00:00\n')
+    assert not eso_download.claim_product('DP2', str(tmp_path))
+
+def test_takeover_does_not_remove_a_fresh_claim(tmp_path):
+    # A worker that judged the old lock stale must not remove the lock another worker created since
+    assert eso_download.claim_product('DP1', str(tmp_path))
+    eso_download.take_over_stale_claim(str(tmp_path / 'DP1.lock'))
+    assert sorted(os.listdir(tmp_path)) == ['DP1.lock']
+
+def test_release_keeps_claims_of_other_workers(tmp_path):
+    (tmp_path / 'DP1.lock').write_text('otherhost 1 2020-01-01T00:00:00\n')
+    eso_download.release_product('DP1', str(tmp_path), done=False)
+    assert os.listdir(tmp_path) == ['DP1.lock']
+
+def test_claims_are_kept_per_download_dir(tmp_path):
+    lock_a = eso_download.claims_dir(str(tmp_path), '/data/progA')
+    lock_b = eso_download.claims_dir(str(tmp_path), '/data/progB')
+    assert lock_a != lock_b
+    assert eso_download.claim_product('CAL1', lock_a)
+    eso_download.release_product('CAL1', lock_a, done=True)
+    assert eso_download.claim_product('CAL1', lock_b)
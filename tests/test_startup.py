@@ -0,0 +1,29 @@
+"""Cold-start guard: importing eso_download must stay cheap for sorting-only runs and batch schedulers."""
+
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['pyvo', 'astropy', 'numpy', 'requests']
+
+def import_in_subprocess():
+    code = ("import json, sys, time\n"
+            "t = time.perf_counter()\n"
+            "import eso_download\n"
+            "elapsed = time.perf_counter() - t\n"
+            "print(json.dumps({'elapsed': elapsed, 'modules': sorted(sys.modules)}))\n")
+    out = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, check=True,
+                         capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def test_import_does_not_load_heavy_dependencies():
+    modules = import_in_subprocess()['modules']
+    loaded = [m for m in HEAVY_MODULES if m in modules]
+    assert loaded == [], "eagerly imported: %s" % ', '.join(loaded)
+
+def test_import_time():
+    # Loose bound: a lazy import takes tens of milliseconds, an eager one seconds
+    assert import_in_subprocess()['elapsed'] < 0.5